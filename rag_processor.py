@@ -4,59 +4,45 @@ RAG Processor for Israeli Company Database
 Enhances company data with AI-generated descriptions and embeddings
 """
 
-import json
-import re
+import asyncio
+import hashlib
+import ijson
+import os
+import random
+import sqlite3
 import time
+from collections import OrderedDict
 import numpy as np
-from typing import Dict, List, Any, Optional
-from openai import OpenAI
-from sklearn.metrics.pairwise import cosine_similarity
+import orjson
+from aiolimiter import AsyncLimiter
+from typing import Dict, List, Any, Optional, Tuple
+import openai
+from openai import AsyncOpenAI
 from tqdm import tqdm
 import logging
 
+try:
+    import hnswlib
+except ImportError:  # optional: only needed for approximate search on large catalogs
+    hnswlib = None
+
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-class RAGProcessor:
-    def __init__(self, api_key: str):
-        """Initialize RAG processor with OpenAI API key"""
-        self.client = OpenAI(api_key=api_key)
-        self.companies = []
-        self.enriched_companies = []
-        
-    def load_company_data(self, file_path: str) -> None:
-        """Load company data from JSON file"""
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                
-            self.companies = data.get('companies', [])
-            self.regions = data.get('regions', [])  
-            self.company_types = data.get('companyTypes', [])
-            
-            logger.info(f"Loaded {len(self.companies)} companies, {len(self.regions)} regions, {len(self.company_types)} company types")
-            
-        except Exception as e:
-            logger.error(f"Error loading data: {e}")
-            raise
-    
-    def enrich_company_description(self, company: Dict[str, Any]) -> Dict[str, Any]:
-        """Generate AI-enhanced description for a single company"""
-        try:
-            # Create context for GPT
-            company_context = f"""
-Company Name: {company.get('companyName', 'Unknown')}
-Type: {company.get('companyType', 'Unknown')}
-Region: {company.get('region', 'Unknown')}
-Comment: {company.get('comment', 'N/A')}
-
-This is an Israeli company that may need architectural services.
-"""
-            
-            prompt = f"""Analyze this Israeli company for architectural opportunities:
+CHAT_MODEL = "gpt-4o-mini"
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 1536  # text-embedding-3-small dimension
+ANN_MIN_COMPANIES = 10000  # below this, brute force beats building an HNSW graph
+QUERY_EMBEDDING_MEMO_SIZE = 4096
+API_MAX_RETRIES = 6
+API_MAX_BACKOFF = 30.0
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
 
-{company_context}
+# Static instructions shared byte-for-byte by every enrichment request, so the
+# API can reuse its prompt-prefix cache; per-company details are appended last
+_PROMPT_PREFIX = """Analyze the Israeli company described at the end of this message for architectural opportunities.
+It is an Israeli company that may need architectural services.
 
 Based on the company type and context, provide a detailed analysis in Hebrew including:
 
@@ -67,7 +53,7 @@ Based on the company type and context, provide a detailed analysis in Hebrew inc
 5. How architects typically collaborate with this type of organization
 
 Please respond with a JSON object in the following format:
-{{
+{
   "aiDescription": "detailed Hebrew description of architectural opportunities",
   "projectTypes": ["list", "of", "likely", "project", "types"],
   "architectSpecialties": ["relevant", "architectural", "specializations"],
@@ -75,43 +61,311 @@ Please respond with a JSON object in the following format:
   "typicalScale": "small/medium/large",
   "collaborationStyle": "typical approach for working with this organization",
   "marketTrends": "current relevant trends in Israeli market"
-}}
+}
 
 Ensure all text is in Hebrew and relevant to the Israeli architectural market."""
 
-            response = self.client.chat.completions.create(
-                model="gpt-4",
+def normalize_rows(M: np.ndarray) -> np.ndarray:
+    """L2-normalize rows in place so cosine similarity becomes a plain dot product"""
+    # The epsilon keeps fallback zero vectors at zero instead of NaN
+    M /= np.linalg.norm(M, axis=1, keepdims=True) + 1e-12
+    return M
+
+def stream_company_file(file_path: str, drop_embeddings: bool = False) -> Dict[str, List[Any]]:
+    """Stream-parse regions, companyTypes and companies from a JSON file in a single pass
+    
+    Only one array item is materialized at a time, so peak memory stays close to the
+    size of the resulting Python objects rather than the whole parse tree. With
+    drop_embeddings, inline company embeddings are skipped at the event level and
+    never built.
+    """
+    sections = {'regions': [], 'companyTypes': [], 'companies': []}
+    prefixes = {f'{name}.item': name for name in sections}
+    builder, current, depth = None, None, 0
+    skipping, skip_depth = False, 0
+    
+    with open(file_path, 'rb') as f:
+        for prefix, event, value in ijson.parse(f, use_float=True):
+            if skipping:
+                # Inside a company's embedding value: drop events until it is complete,
+                # which for a scalar (null, number, ...) is the first event after the key
+                if event in ('start_map', 'start_array'):
+                    skip_depth += 1
+                elif event in ('end_map', 'end_array'):
+                    skip_depth -= 1
+                skipping = skip_depth > 0
+                continue
+            if builder is None:
+                if prefix not in prefixes:
+                    continue
+                if event not in ('start_map', 'start_array'):
+                    # Scalar array item
+                    sections[prefixes[prefix]].append(value)
+                    continue
+                builder, current, depth = ijson.ObjectBuilder(), prefixes[prefix], 0
+            
+            if drop_embeddings and event == 'map_key' and value == 'embedding' and prefix == 'companies.item':
+                # Never build the embedding list; skip its key and every nested event
+                skipping, skip_depth = True, 0
+                continue
+            
+            builder.event(event, value)
+            if event in ('start_map', 'start_array'):
+                depth += 1
+            elif event in ('end_map', 'end_array'):
+                depth -= 1
+                if depth == 0:
+                    sections[current].append(builder.value)
+                    builder = None
+    
+    return sections
+
+def embeddings_path(json_path: str) -> str:
+    """Path of the float16 embedding matrix stored next to an enhanced JSON file"""
+    return os.path.splitext(json_path)[0] + '.emb.npy'
+
+def ann_index_path(json_path: str) -> str:
+    """Path of the persisted HNSW graph stored next to an enhanced JSON file"""
+    return os.path.splitext(json_path)[0] + '.hnsw.bin'
+
+class EmbeddingCache:
+    """On-disk embedding cache keyed by SHA-256 of model name and text"""
+    
+    def __init__(self, path: str):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL)")
+        self.conn.commit()
+    
+    @staticmethod
+    def key(text: str) -> bytes:
+        return hashlib.sha256((EMBEDDING_MODEL + text).encode('utf-8')).digest()
+    
+    def get_many(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Look up cached embeddings, returning None for misses (all misses if the cache fails)"""
+        found = {}
+        try:
+            for text in set(texts):
+                row = self.conn.execute("SELECT vector FROM embeddings WHERE key = ?", (self.key(text),)).fetchone()
+                if row is not None:
+                    found[text] = np.frombuffer(row[0], dtype=np.float16).astype(np.float32)
+        except Exception as e:
+            logger.warning(f"Embedding cache read failed, treating as misses: {e}")
+            return [None] * len(texts)
+        return [found.get(text) for text in texts]
+    
+    def put_many(self, texts: List[str], embeddings: List[np.ndarray]) -> None:
+        """Store embeddings as float16 bytes; failures are logged, not raised"""
+        try:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector) VALUES (?, ?)",
+                [(self.key(text), np.asarray(embedding, dtype=np.float16).tobytes())
+                 for text, embedding in zip(texts, embeddings)]
+            )
+            self.conn.commit()
+        except Exception as e:
+            logger.warning(f"Embedding cache write failed: {e}")
+    
+    def close(self) -> None:
+        self.conn.close()
+
+class QueryCache:
+    """Semantic cache of search hits (company index, score) keyed by query embedding proximity"""
+    
+    def __init__(self, threshold: float = 0.97, max_size: int = 10000):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.clear()
+    
+    def clear(self) -> None:
+        # float16 halves the footprint (~31 MB at 10k entries); ~1e-3 error is far below the threshold margin
+        self._emb = np.empty((0, EMBEDDING_DIM), dtype=np.float16)
+        self._size = 0
+        self._results: List[List[Tuple[int, float]]] = []
+        self._top_k: List[int] = []
+        self._last_used: List[int] = []
+        self._tick = 0
+    
+    def lookup(self, q: np.ndarray, top_k: int) -> Optional[List[Tuple[int, float]]]:
+        """Return cached hits for a normalized query close enough to a previous one"""
+        if self._size == 0:
+            return None
+        
+        # Upcast a block at a time so the float32 temporary stays small
+        hits = np.empty(self._size, dtype=np.float32)
+        for start in range(0, self._size, 1024):
+            stop = min(start + 1024, self._size)
+            hits[start:stop] = self._emb[start:stop].astype(np.float32) @ q
+        j = int(np.argmax(hits))
+        if hits[j] < self.threshold or self._top_k[j] < top_k:
+            return None
+        
+        self._tick += 1
+        self._last_used[j] = self._tick
+        return self._results[j][:top_k]
+    
+    def store(self, q: np.ndarray, top_k: int, results: List[Tuple[int, float]]) -> None:
+        """Remember hits for a normalized query, evicting the least recently used entry when full"""
+        self._tick += 1
+        if self._size >= self.max_size:
+            j = int(np.argmin(self._last_used))
+            self._results[j] = results
+            self._top_k[j] = top_k
+            self._last_used[j] = self._tick
+        else:
+            if self._size == len(self._emb):
+                # Grow geometrically so appends stay amortized O(d)
+                grown = np.empty((min(max(2 * self._size, 64), self.max_size), EMBEDDING_DIM), dtype=np.float16)
+                grown[:self._size] = self._emb[:self._size]
+                self._emb = grown
+            j = self._size
+            self._size += 1
+            self._results.append(results)
+            self._top_k.append(top_k)
+            self._last_used.append(self._tick)
+        self._emb[j] = q
+
+class RAGProcessor:
+    def __init__(self, api_key: str, max_concurrency: int = 8,
+                 cache_path: Optional[str] = '.embedding_cache.sqlite',
+                 requests_per_minute: int = 3500):
+        """Initialize RAG processor with OpenAI API key"""
+        # Retries are done in _call_api so every attempt takes a limiter token
+        self.client = AsyncOpenAI(api_key=api_key, max_retries=0)
+        self.max_concurrency = max_concurrency
+        # Token bucket pacing requests to the account's RPM quota
+        self._limiter = AsyncLimiter(requests_per_minute, 60)
+        self._emb_cache = EmbeddingCache(cache_path) if cache_path else None
+        # Process-local LRU of query text -> float32 bytes, checked before the disk cache
+        self._query_embeddings = OrderedDict()
+        self.companies = []
+        self.enriched_companies = []
+        self._emb_matrix: Optional[np.ndarray] = None
+        self._ann_index = None
+        self._query_cache = QueryCache()
+        
+    def load_company_data(self, file_path: str) -> None:
+        """Load company data from JSON file"""
+        try:
+            data = stream_company_file(file_path)
+            
+            self.companies = data['companies']
+            self.regions = data['regions']
+            self.company_types = data['companyTypes']
+            
+            logger.info(f"Loaded {len(self.companies)} companies, {len(self.regions)} regions, {len(self.company_types)} company types")
+            
+        except Exception as e:
+            logger.error(f"Error loading data: {e}")
+            raise
+    
+    def load_enhanced_data(self, file_path: str) -> None:
+        """Load previously enriched data and its embedding index for searching"""
+        try:
+            # With a sidecar present, any inline embeddings are redundant
+            emb_path = embeddings_path(file_path)
+            M = np.load(emb_path, mmap_mode='r') if os.path.exists(emb_path) else None
+            data = stream_company_file(file_path, drop_embeddings=M is not None)
+            
+            if M is not None and M.shape != (len(data['companies']), EMBEDDING_DIM):
+                logger.warning(f"Ignoring {emb_path}: shape {M.shape} does not match "
+                               f"{len(data['companies'])} companies; using inline embeddings")
+                M = None
+                data = stream_company_file(file_path)
+            
+            self.enriched_companies = data['companies']
+            self.regions = data['regions']
+            self.company_types = data['companyTypes']
+            
+            if M is not None:
+                # Dequantize the memory-mapped float16 sidecar to float32 in one pass;
+                # renormalize since float16 rounding leaves rows slightly off unit length
+                self._set_index(normalize_rows(M.astype(np.float32)), ann_path=ann_index_path(file_path),
+                                source_path=emb_path)
+            elif all('embedding' in company for company in self.enriched_companies):
+                # Older files carry embeddings inline on each company
+                self._finalize_index()
+            else:
+                raise ValueError(f"{file_path} has no inline embeddings and no valid {emb_path}")
+            
+            logger.info(f"Loaded {len(self.enriched_companies)} enriched companies")
+            
+        except Exception as e:
+            logger.error(f"Error loading enhanced data: {e}")
+            raise
+    
+    async def _call_api(self, create: Any, **kwargs: Any) -> Any:
+        """Call an OpenAI endpoint, taking a limiter token per attempt and retrying transient errors
+        
+        Backoff is exponential with jitter, or the server's Retry-After when given, capped at
+        API_MAX_BACKOFF seconds.
+        """
+        for attempt in range(API_MAX_RETRIES + 1):
+            try:
+                async with self._limiter:
+                    return await create(**kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt == API_MAX_RETRIES:
+                    raise
+                delay = min(0.5 * 2 ** attempt, API_MAX_BACKOFF) * (0.75 + random.random() / 2)
+                response = getattr(e, 'response', None)
+                retry_after = response.headers.get('retry-after') if response is not None else None
+                try:
+                    # Honour the server's hint, capped so one response cannot stall a worker
+                    delay = min(max(float(retry_after), 0.0), API_MAX_BACKOFF) if retry_after else delay
+                except ValueError:
+                    pass
+                logger.warning(f"{type(e).__name__}, retrying in {delay:.2f}s ({attempt + 1}/{API_MAX_RETRIES})")
+                await asyncio.sleep(delay)
+    
+    async def enrich_company_description(self, company: Dict[str, Any]) -> Dict[str, Any]:
+        """Generate AI-enhanced description for a single company"""
+        try:
+            # Only the company context varies, and it goes last
+            company_context = (
+                f"Company Name: {company.get('companyName', 'Unknown')}\n"
+                f"Type: {company.get('companyType', 'Unknown')}\n"
+                f"Region: {company.get('region', 'Unknown')}\n"
+                f"Comment: {company.get('comment', 'N/A')}"
+            )
+            prompt = _PROMPT_PREFIX + "\n\nCOMPANY:\n" + company_context
+            
+            response = await self._call_api(
+                self.client.chat.completions.create,
+                model=CHAT_MODEL,
                 messages=[{"role": "user", "content": prompt}],
+                response_format={"type": "json_object"},
                 temperature=0.3,
                 max_tokens=1000
             )
             
-            # Parse the response
-            ai_data = json.loads(response.choices[0].message.content)
-            
-            # Add AI enhancements to company data
-            enhanced_company = company.copy()
-            enhanced_company.update(ai_data)
+            # JSON mode guarantees a bare JSON object, no markdown fences
+            ai_data = orjson.loads(response.choices[0].message.content)
             
             # Create searchable text for embedding
-            searchable_text = f"""
-            {company.get('companyName', '')}
-            {company.get('companyType', '')}
-            {company.get('region', '')}
-            {ai_data.get('aiDescription', '')}
-            {' '.join(ai_data.get('projectTypes', []))}
-            {' '.join(ai_data.get('architectSpecialties', []))}
-            {ai_data.get('collaborationStyle', '')}
-            {ai_data.get('marketTrends', '')}
-            """
-            enhanced_company['searchableText'] = searchable_text.strip()
+            # Single-space join keeps indentation whitespace out of the embedding tokens
+            searchable_text = " ".join(filter(None, [
+                company.get('companyName', ''),
+                company.get('companyType', ''),
+                company.get('region', ''),
+                ai_data.get('aiDescription', ''),
+                *ai_data.get('projectTypes', []),
+                *ai_data.get('architectSpecialties', []),
+                ai_data.get('collaborationStyle', ''),
+                ai_data.get('marketTrends', '')
+            ]))
+            
+            # Add AI enhancements in place only once everything above succeeded;
+            # the raw record is not used again
+            enhanced_company = company
+            enhanced_company.update(ai_data)
+            enhanced_company['searchableText'] = searchable_text
             
             return enhanced_company
             
         except Exception as e:
             logger.error(f"Error enriching company {company.get('companyName', 'Unknown')}: {e}")
             # Return original company with minimal enhancement
-            enhanced_company = company.copy()
+            enhanced_company = company
             enhanced_company.update({
                 'aiDescription': f"חברה מסוג {company.get('companyType', 'לא ידוע')} הממוקמת ב{company.get('region', 'לא ידוע')}",
                 'projectTypes': [],
@@ -122,54 +376,185 @@ Ensure all text is in Hebrew and relevant to the Israeli architectural market.""
             })
             return enhanced_company
     
-    def generate_embedding(self, text: str) -> List[float]:
+    async def generate_embedding(self, text: str) -> np.ndarray:
         """Generate embedding for given text using OpenAI"""
+        memo = self._query_embeddings.get(text)
+        if memo is not None:
+            self._query_embeddings.move_to_end(text)
+            # Zero-copy, read-only view over the memoized bytes
+            return np.frombuffer(memo, dtype=np.float32)
+        
+        embedding = self._emb_cache.get_many([text])[0] if self._emb_cache else None
+        if embedding is not None:
+            self._memoize_query_embedding(text, embedding)
+            return embedding
+        
         try:
-            response = self.client.embeddings.create(
-                model="text-embedding-3-small",
+            response = await self._call_api(
+                self.client.embeddings.create,
+                model=EMBEDDING_MODEL,
                 input=text
             )
-            return response.data[0].embedding
+            embedding = np.asarray(response.data[0].embedding, dtype=np.float32)
         except Exception as e:
             logger.error(f"Error generating embedding: {e}")
             # Return zero vector as fallback
-            return [0.0] * 1536  # text-embedding-3-small dimension
+            return np.zeros(EMBEDDING_DIM, dtype=np.float32)
+        
+        if self._emb_cache:
+            self._emb_cache.put_many([text], [embedding])
+        self._memoize_query_embedding(text, embedding)
+        return embedding
+    
+    def _memoize_query_embedding(self, text: str, embedding: np.ndarray) -> None:
+        """Remember a query embedding, evicting the least recently used one when full"""
+        self._query_embeddings[text] = embedding.astype(np.float32, copy=False).tobytes()
+        self._query_embeddings.move_to_end(text)
+        if len(self._query_embeddings) > QUERY_EMBEDDING_MEMO_SIZE:
+            self._query_embeddings.popitem(last=False)
     
-    def batch_enrich_companies(self, batch_size: int = 10) -> None:
+    async def generate_embeddings(self, texts: List[str]) -> List[np.ndarray]:
+        """Generate embeddings for a list of texts in a single OpenAI request"""
+        if self._emb_cache:
+            embeddings = self._emb_cache.get_many(texts)
+        else:
+            embeddings = [None] * len(texts)
+        
+        # Only send cache misses to the API
+        misses = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if not misses:
+            return embeddings
+        
+        # Identical texts (e.g. fallback descriptions) are embedded once
+        unique: Dict[bytes, str] = {}
+        order = []
+        for i in misses:
+            h = hashlib.blake2b(texts[i].encode('utf-8'), digest_size=16).digest()
+            unique.setdefault(h, texts[i])
+            order.append(h)
+        
+        keys = list(unique.keys())
+        try:
+            response = await self._call_api(
+                self.client.embeddings.create,
+                model=EMBEDDING_MODEL,
+                input=list(unique.values())
+            )
+            # The API may not return items in input order; index explicitly
+            emb_by_h = {keys[item.index]: np.asarray(item.embedding, dtype=np.float32) for item in response.data}
+        except Exception as e:
+            logger.error(f"Error generating batch embeddings: {e}")
+            emb_by_h = {}
+        
+        missing = 0
+        for i, h in zip(misses, order):
+            embedding = emb_by_h.get(h)
+            if embedding is None:
+                # Zero vector fallback for anything the API did not return
+                embedding = np.zeros(EMBEDDING_DIM, dtype=np.float32)
+                missing += 1
+            embeddings[i] = embedding
+        if emb_by_h and missing:
+            logger.error(f"Embedding response was missing {missing} of {len(misses)} texts")
+        
+        if self._emb_cache and emb_by_h:
+            self._emb_cache.put_many([unique[h] for h in emb_by_h], list(emb_by_h.values()))
+        return embeddings
+    
+    async def _process_batch(self, batch: List[Dict[str, Any]], semaphore: asyncio.Semaphore,
+                             progress: tqdm) -> List[Dict[str, Any]]:
+        """Enrich a batch of companies, then embed the whole batch in one request"""
+        async def enrich(company: Dict[str, Any]) -> Dict[str, Any]:
+            async with semaphore:
+                enhanced_company = await self.enrich_company_description(company)
+            progress.update(1)
+            return enhanced_company
+        
+        enhanced_batch = await asyncio.gather(*[enrich(company) for company in batch])
+        
+        # One embeddings round trip for the whole batch
+        texts = [company.get('searchableText', '') for company in enhanced_batch]
+        try:
+            async with semaphore:
+                embeddings = await self.generate_embeddings(texts)
+        except Exception as e:
+            # Keep one bad batch from aborting the whole gather
+            logger.error(f"Error embedding batch of {len(batch)} companies: {e}")
+            embeddings = [np.zeros(EMBEDDING_DIM, dtype=np.float32) for _ in texts]
+        
+        for company, embedding in zip(enhanced_batch, embeddings):
+            company['embedding'] = embedding
+        
+        return enhanced_batch
+    
+    async def batch_enrich_companies(self, batch_size: int = 10) -> None:
         """Enrich all companies with AI descriptions and embeddings"""
         logger.info(f"Starting to enrich {len(self.companies)} companies...")
         
-        # Process companies in batches to avoid rate limits
-        for i in tqdm(range(0, len(self.companies), batch_size), desc="Processing companies"):
-            batch = self.companies[i:i + batch_size]
-            
-            for company in batch:
-                try:
-                    # Enrich with AI description
-                    enhanced_company = self.enrich_company_description(company)
-                    
-                    # Generate embedding
-                    embedding = self.generate_embedding(enhanced_company['searchableText'])
-                    enhanced_company['embedding'] = embedding
-                    
-                    self.enriched_companies.append(enhanced_company)
-                    
-                    # Small delay to respect rate limits
-                    time.sleep(0.5)
-                    
-                except Exception as e:
-                    logger.error(f"Failed to process company {company.get('companyName', 'Unknown')}: {e}")
-                    # Add company without enhancements
-                    fallback_company = company.copy()
-                    fallback_company['embedding'] = [0.0] * 1536
-                    self.enriched_companies.append(fallback_company)
-            
-            # Longer delay between batches
-            if i + batch_size < len(self.companies):
-                logger.info(f"Processed {i + batch_size} companies. Waiting...")
-                time.sleep(2)
+        # Bound the number of in-flight requests instead of sleeping between them
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        progress = tqdm(total=len(self.companies), desc="Processing companies")
+        
+        batches = [self.companies[i:i + batch_size] for i in range(0, len(self.companies), batch_size)]
+        
+        try:
+            # gather preserves input order, so results line up with self.companies
+            results = await asyncio.gather(*[self._process_batch(batch, semaphore, progress)
+                                             for batch in batches])
+        finally:
+            progress.close()
+        
+        for enhanced_batch in results:
+            self.enriched_companies.extend(enhanced_batch)
+        
+        self._finalize_index()
     
-    def semantic_search(self, query: str, top_k: int = 20) -> List[Dict[str, Any]]:
+    def _finalize_index(self) -> None:
+        """Build a contiguous, L2-normalized float32 matrix of company embeddings"""
+        if not self.enriched_companies:
+            self._set_index(np.empty((0, EMBEDDING_DIM), dtype=np.float32))
+            return
+        M = np.asarray([comp['embedding'] for comp in self.enriched_companies], dtype=np.float32)
+        self._set_index(normalize_rows(M))
+    
+    def _set_index(self, M: np.ndarray, ann_path: Optional[str] = None,
+                   source_path: Optional[str] = None) -> None:
+        """Install an L2-normalized embedding matrix, adding an HNSW index for large catalogs
+        
+        When ann_path holds a graph at least as new as source_path (the sidecar M was
+        loaded from) and with one element per row, it is loaded instead of rebuilt.
+        """
+        self._emb_matrix = M
+        self._ann_index = None
+        self._query_cache.clear()
+        
+        if hnswlib is None or len(M) < ANN_MIN_COMPANIES:
+            return
+        
+        index = hnswlib.Index(space='cosine', dim=M.shape[1])
+        fresh = (ann_path is not None and source_path is not None and os.path.exists(ann_path)
+                 and os.path.getmtime(ann_path) >= os.path.getmtime(source_path))
+        if fresh:
+            try:
+                index.load_index(ann_path, max_elements=len(M))
+                fresh = index.get_current_count() == len(M)
+            except Exception as e:
+                logger.warning(f"Could not load HNSW index from {ann_path}: {e}")
+                fresh = False
+            if fresh:
+                logger.info(f"Loaded HNSW index from {ann_path}")
+            else:
+                index = hnswlib.Index(space='cosine', dim=M.shape[1])
+        if not fresh:
+            index.init_index(max_elements=len(M), M=16, ef_construction=200)
+            index.add_items(M, ids=np.arange(len(M)))
+            logger.info(f"Built HNSW index over {len(M)} companies")
+            if ann_path is not None:
+                index.save_index(ann_path)
+        index.set_ef(100)
+        self._ann_index = index
+    
+    async def semantic_search(self, query: str, top_k: int = 20) -> List[Dict[str, Any]]:
         """Perform semantic search using embeddings"""
         if not self.enriched_companies:
             logger.error("No enriched companies available. Run batch_enrich_companies first.")
@@ -177,59 +562,124 @@ Ensure all text is in Hebrew and relevant to the Israeli architectural market.""
         
         try:
             # Generate query embedding
-            query_embedding = self.generate_embedding(query)
+            query_embedding = await self.generate_embedding(query)
+            
+            if self._emb_matrix is None or len(self._emb_matrix) != len(self.enriched_companies):
+                self._finalize_index()
             
-            # Calculate similarities
-            company_embeddings = [comp['embedding'] for comp in self.enriched_companies]
-            similarities = cosine_similarity([query_embedding], company_embeddings)[0]
+            # Cosine similarity is a single matrix-vector product on normalized rows
+            q = np.asarray(query_embedding, dtype=np.float32)
+            q_norm = np.linalg.norm(q)
+            if q_norm == 0:
+                return []
+            q = q / q_norm
             
-            # Add similarity scores and sort
-            results = []
-            for i, company in enumerate(self.enriched_companies):
-                if similarities[i] > 0.3:  # Relevance threshold
-                    company_with_score = company.copy()
-                    company_with_score['similarity_score'] = float(similarities[i])
-                    results.append(company_with_score)
+            # Rephrasings of a previous query reuse its hits
+            cached = self._query_cache.lookup(q, top_k)
+            if cached is not None:
+                return self._search_results(cached)
+            
+            if self._ann_index is not None:
+                # Approximate nearest neighbours, already sorted best first
+                labels, distances = self._ann_index.knn_query(q, k=min(top_k, len(self.enriched_companies)))
+                top_sims = 1.0 - distances[0]
+                keep = top_sims > 0.3  # Relevance threshold
+                top, scores = labels[0][keep], top_sims[keep]
+            else:
+                sims = self._emb_matrix @ q
+                
+                # Keep companies above the relevance threshold
+                idx = np.where(sims > 0.3)[0]
+                
+                # Partial selection of the top k, then sort only those k
+                if len(idx) > top_k:
+                    top = idx[np.argpartition(-sims[idx], top_k)[:top_k]]
+                else:
+                    top = idx
+                top = top[np.argsort(-sims[top])]
+                scores = sims[top]
             
-            # Sort by similarity and return top k
-            results.sort(key=lambda x: x['similarity_score'], reverse=True)
-            return results[:top_k]
+            hits = [(int(i), float(score)) for i, score in zip(top, scores)]
+            self._query_cache.store(q, top_k, hits)
+            return self._search_results(hits)
             
         except Exception as e:
             logger.error(f"Error in semantic search: {e}")
             return []
     
-    def save_enhanced_data(self, output_file: str) -> None:
-        """Save enriched data to JSON file"""
+    def _search_results(self, hits: List[Tuple[int, float]]) -> List[Dict[str, Any]]:
+        """Build fresh result dicts from the live records, without the raw embedding"""
+        results = []
+        for i, score in hits:
+            result = {k: v for k, v in self.enriched_companies[i].items() if k != 'embedding'}
+            result['similarity_score'] = score
+            results.append(result)
+        return results
+    
+    def save_enhanced_data(self, output_file: str, inline_embeddings: bool = False) -> None:
+        """Save enriched data to JSON file, with embeddings in a companion .npy
+        
+        inline_embeddings also writes each company's vector into the JSON, rounded to
+        4 decimals, for consumers that cannot read the .npy sidecar.
+        """
         try:
+            if self._emb_matrix is None or len(self._emb_matrix) != len(self.enriched_companies):
+                self._finalize_index()
+            
+            # The sidecar matrix is aligned by company index
+            emb_path = embeddings_path(output_file)
+            M16 = self._emb_matrix.astype(np.float16)
+            
+            # Built from the live records so edits made after indexing are saved
+            companies = [{k: v for k, v in company.items() if k != 'embedding'}
+                         for company in self.enriched_companies]
+            if inline_embeddings:
+                # Rounded float32 values serialize as short decimals
+                rows = np.round(self._emb_matrix, 4)
+                companies = [{**view, 'embedding': rows[i]} for i, view in enumerate(companies)]
+            
             enhanced_data = {
                 'regions': self.regions,
                 'companyTypes': self.company_types,
-                'companies': self.enriched_companies,
+                'companies': companies,
                 'metadata': {
                     'total_companies': len(self.enriched_companies),
                     'rag_enhanced': True,
-                    'embedding_model': 'text-embedding-3-small',
+                    'chat_model': CHAT_MODEL,
+                    'embedding_model': EMBEDDING_MODEL,
+                    'embeddings_file': os.path.basename(emb_path),
                     'processed_at': time.strftime('%Y-%m-%d %H:%M:%S')
                 }
             }
             
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(enhanced_data, f, ensure_ascii=False, indent=2)
+            with open(output_file, 'wb') as f:
+                f.write(orjson.dumps(enhanced_data, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_INDENT_2))
+            
+            # Persist the normalized index quantized to float16
+            np.save(emb_path, M16)
+            if self._ann_index is not None:
+                # Saved after the sidecar so the graph's mtime marks it as fresh
+                self._ann_index.save_index(ann_index_path(output_file))
             
-            logger.info(f"Enhanced data saved to {output_file}")
+            logger.info(f"Enhanced data saved to {output_file} (embeddings in {emb_path})")
             
         except Exception as e:
             logger.error(f"Error saving enhanced data: {e}")
             raise
     
-    def test_search(self, test_queries: List[str]) -> None:
+    async def close(self) -> None:
+        """Release the API client and the embedding cache"""
+        await self.client.close()
+        if self._emb_cache:
+            self._emb_cache.close()
+    
+    async def test_search(self, test_queries: List[str]) -> None:
         """Test the semantic search with sample queries"""
         logger.info("Testing semantic search...")
         
         for query in test_queries:
             logger.info(f"\nQuery: {query}")
-            results = self.semantic_search(query, top_k=5)
+            results = await self.semantic_search(query, top_k=5)
             
             if results:
                 logger.info(f"Found {len(results)} results:")
@@ -242,7 +692,6 @@ Ensure all text is in Hebrew and relevant to the Israeli architectural market.""
 
 def main():
     """Main function to run RAG processing"""
-    import os
     from dotenv import load_dotenv
     
     # Load environment variables
@@ -256,6 +705,10 @@ def main():
     # Initialize processor
     processor = RAGProcessor(API_KEY)
     
+    asyncio.run(run_pipeline(processor))
+
+async def run_pipeline(processor: RAGProcessor) -> None:
+    """Load, enrich, save and test-search companies on a single event loop"""
     try:
         # Load original data
         processor.load_company_data('map-clean.json')
@@ -266,7 +719,7 @@ def main():
         processor.companies = test_companies
         
         # Enrich companies with AI descriptions and embeddings
-        processor.batch_enrich_companies(batch_size=5)
+        await processor.batch_enrich_companies(batch_size=5)
         
         # Save enhanced data
         processor.save_enhanced_data('map-enhanced.json')
@@ -279,13 +732,15 @@ def main():
             "עיריות",
             "מוסדות תרבות"
         ]
-        processor.test_search(test_queries)
+        await processor.test_search(test_queries)
         
         logger.info("RAG processing completed successfully!")
         
     except Exception as e:
         logger.error(f"Error in main processing: {e}")
         raise
+    finally:
+        await processor.close()
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
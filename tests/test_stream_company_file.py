@@ -0,0 +1,54 @@
+import json
+
+import pytest
+
+from rag_processor import stream_company_file
+
+
+def write_json(tmp_path, data):
+    path = tmp_path / 'companies.json'
+    path.write_text(json.dumps(data))
+    return str(path)
+
+
+@pytest.mark.parametrize('embedding', [
+    None,
+    0.5,
+    'n/a',
+    [],
+    [0.1, 0.2],
+    [[0.1], [0.2]],
+    {'values': [0.1], 'model': 'x'},
+])
+def test_drop_embeddings_skips_any_value(tmp_path, embedding):
+    path = write_json(tmp_path, {'companies': [
+        {'id': 1, 'embedding': embedding, 'x': 2},
+        {'id': 2, 'embedding': [0.1], 'y': 3},
+        {'id': 3},
+    ]})
+    
+    sections = stream_company_file(path, drop_embeddings=True)
+    
+    assert sections['companies'] == [{'id': 1, 'x': 2}, {'id': 2, 'y': 3}, {'id': 3}]
+
+
+def test_keeps_embeddings_without_drop(tmp_path):
+    path = write_json(tmp_path, {'companies': [{'id': 1, 'embedding': None}, {'id': 2, 'embedding': [0.5]}]})
+    
+    sections = stream_company_file(path)
+    
+    assert sections['companies'] == [{'id': 1, 'embedding': None}, {'id': 2, 'embedding': [0.5]}]
+
+
+def test_only_top_level_company_embedding_is_dropped(tmp_path):
+    path = write_json(tmp_path, {
+        'regions': ['north', 'south'],
+        'companyTypes': [{'id': 'a', 'embedding': 1}],
+        'companies': [{'id': 1, 'meta': {'embedding': 7}, 'embedding': [0.1]}],
+    })
+    
+    sections = stream_company_file(path, drop_embeddings=True)
+    
+    assert sections['regions'] == ['north', 'south']
+    assert sections['companyTypes'] == [{'id': 'a', 'embedding': 1}]
+    assert sections['companies'] == [{'id': 1, 'meta': {'embedding': 7}}]